@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+"""
+音声デコード処理のベンチマーク
+
+従来の方法 (pydub/ffmpeg -> get_array_of_samples -> Numpy) と
+MalodyCog._decode_audio (WAV/OGG/FLACはsoundfileで直接デコード) の速度を比較する
+
+使い方: python benchmarks/bench_audio_decode.py <音声ファイル> [<音声ファイル> ...] [--repeat N]
+"""
+
+import argparse
+import io
+import os
+import sys
+import time
+
+import numpy as np
+from pydub import AudioSegment
+
+# リポジトリのルートからcogsをインポートできるようにする
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from cogs.malody_cog import MalodyCog
+
+
+def legacy_decode(audio_bytes, audio_format):
+    """変更前の _process_audio と同じ手順でデコードする (比較用)"""
+    sound = AudioSegment.from_file(io.BytesIO(audio_bytes), format=audio_format)
+    y = np.array(sound.get_array_of_samples()).astype(np.float32) / (1 << (sound.sample_width * 8 - 1))
+    if sound.channels == 2:
+        y = y.reshape((-1, 2)).T
+    return y, sound.frame_rate
+
+
+def best_time(func, repeat):
+    """repeat回実行して最速の時間 (秒) と最後の戻り値を返す"""
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="音声デコード処理のベンチマーク")
+    parser.add_argument("files", nargs="+", help="ベンチマークに使う音声ファイル")
+    parser.add_argument("--repeat", type=int, default=3, help="各処理の試行回数 (最速値を採用)")
+    args = parser.parse_args()
+
+    cog = MalodyCog(None)
+
+    print(f"{'ファイル':<40} {'従来 (秒)':>10} {'新方式 (秒)':>12} {'高速化':>8} {'最大誤差':>10}")
+    for path in args.files:
+        with open(path, "rb") as f:
+            audio_bytes = f.read()
+        audio_format = path.rsplit('.', 1)[-1].lower()
+
+        legacy_time, (legacy_y, _) = best_time(lambda: legacy_decode(audio_bytes, audio_format), args.repeat)
+        new_time, (new_y, _) = best_time(lambda: cog._decode_audio(audio_bytes, audio_format), args.repeat)
+
+        # 長さが異なる場合 (デコーダーによるパディング差) は短い方に合わせて比較する
+        legacy_y = np.atleast_2d(legacy_y)
+        n = min(legacy_y.shape[1], new_y.shape[1])
+        max_error = float(np.max(np.abs(legacy_y[:, :n] - new_y[:, :n]))) if n else 0.0
+
+        name = os.path.basename(path)[:40]
+        print(f"{name:<40} {legacy_time:>10.3f} {new_time:>12.3f} {legacy_time / new_time:>7.1f}x {max_error:>10.2e}")
+
+
+if __name__ == "__main__":
+    main()
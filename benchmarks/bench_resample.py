@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+"""
+ピッチ変更モードのリサンプラー (MalodyCog._resample_rates) の精度・速度のベンチマーク
+
+精度: 正弦波を各レートで変換し、理論値 (周波数 × レート) とのSN比と、
+      出力のナイキスト周波数を超える成分 (エイリアシング) の残り具合を表示する
+端: 44.1kHz以外 (ハイレゾのWAV/FLACなど) の入力も含め、出力の先頭と末尾に
+    曲の反対側のサンプルが混ざっていないか (パディング不足) を確認する
+速度: 指定した長さのステレオ信号を全レートで変換し、1秒あたりに処理できる音声の秒数を表示する
+      --with-encode を付けると、従来の方法 (サンプルレートの書き換え + ffmpegでMP3出力) とも比較する
+
+使い方: python benchmarks/bench_resample.py [--seconds 180] [--rates 1.05 1.1 1.2 1.5] [--with-encode]
+"""
+
+import argparse
+import io
+import os
+import sys
+import time
+from fractions import Fraction
+
+import numpy as np
+from pydub import AudioSegment
+
+# リポジトリのルートからcogsをインポートできるようにする
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from cogs.malody_cog import MalodyCog, RESAMPLE_MAX_PHASES
+
+SAMPLE_RATE = 44100
+# SN比の計算から除外する両端のサンプル数 (ゼロ埋めによる過渡応答)
+EDGE_SAMPLES = 2048
+# 端の確認に使う入力のサンプルレート (標準以外のレートは44.1kHzに変換される)
+EDGE_INPUT_SAMPLE_RATES = (44100, 48000, 88200, 96000)
+# 端の確認で、先頭・末尾から調べるサンプル数と許容する振幅
+EDGE_CHECK_SAMPLES = 64
+EDGE_TOLERANCE = 0.01
+# 端の確認に使う信号の、両端の無音の長さ (秒)
+EDGE_SILENCE_SECONDS = 0.05
+
+
+def check_accuracy(cog, rates):
+    """正弦波を変換し、理論値とのSN比とエイリアシングの残り具合を表示する"""
+    t = np.arange(SAMPLE_RATE * 5) / SAMPLE_RATE
+    print("--- 精度 ---")
+    print(f"{'周波数 (Hz)':>12} {'レート':>8} {'SN比 (dB)':>10}")
+    for freq in (440.0, 5000.0, 12000.0):
+        y = np.sin(2 * np.pi * freq * t).astype(np.float32)[np.newaxis, :]
+        for rate, y_out, out_rate in cog._resample_rates(y, SAMPLE_RATE, rates):
+            if freq * rate >= out_rate / 2 * 0.8:
+                continue # 変換後に遷移帯域・ナイキスト以上になる組み合わせは下のエイリアシング確認で扱う
+            # リサンプラーと同じ分数近似のレートで理論値を計算する
+            step = Fraction(SAMPLE_RATE * rate / out_rate).limit_denominator(RESAMPLE_MAX_PHASES)
+            # 出力の k 番目のサンプルは入力の k * step 番目の位置に相当する
+            expected = np.sin(2 * np.pi * freq * float(step) * np.arange(y_out.shape[1]) / SAMPLE_RATE)
+            signal = expected[EDGE_SAMPLES:-EDGE_SAMPLES]
+            error = y_out[0, EDGE_SAMPLES:-EDGE_SAMPLES] - signal
+            snr = 10 * np.log10(np.mean(signal ** 2) / np.mean(error ** 2))
+            print(f"{freq:>12.0f} {rate:>8.3f} {snr:>10.1f}")
+
+    print("--- エイリアシング (変換後にナイキスト周波数を超える正弦波の残留レベル) ---")
+    print(f"{'周波数 (Hz)':>12} {'レート':>8} {'残留 (dB)':>10}")
+    for freq in (16000.0, 20000.0):
+        y = np.sin(2 * np.pi * freq * t).astype(np.float32)[np.newaxis, :]
+        for rate, y_out, out_rate in cog._resample_rates(y, SAMPLE_RATE, [r for r in rates if freq * r > out_rate / 2 * 1.05]):
+            residual = np.sqrt(np.mean(y_out[0, EDGE_SAMPLES:-EDGE_SAMPLES] ** 2)) / np.sqrt(0.5)
+            print(f"{freq:>12.0f} {rate:>8.3f} {20 * np.log10(residual + 1e-12):>10.1f}")
+
+
+def check_edges(cog, rates):
+    """
+    端を無音にした正弦波を変換し、出力の先頭・末尾も無音のままになっているか確認する
+    パディングが足りないと、先頭のサンプルが曲の末尾 (フルスケールの正弦波) を参照してしまう
+    :return: 問題がなければ True
+    """
+    print("--- 端 (先頭・末尾のサンプル) ---")
+    print(f"{'入力 (Hz)':>10} {'レート':>8} {'先頭':>8} {'末尾':>8}")
+    ok = True
+    for sample_rate in EDGE_INPUT_SAMPLE_RATES:
+        n = sample_rate * 2
+        tone = np.sin(2 * np.pi * 440.0 * np.arange(n) / sample_rate).astype(np.float32)
+        silence = int(sample_rate * EDGE_SILENCE_SECONDS)
+        # 左チャンネルは先頭だけ、右チャンネルは末尾だけを無音にする
+        # (反対側の端には正弦波が残っているので、そこを参照すると検出できる)
+        y = np.stack([tone, tone])
+        y[0, :silence] = 0.0
+        y[1, -silence:] = 0.0
+        for rate in rates:
+            # パディングは同時に変換する中で最も速いレートに合わせて決まるため、1レートずつ変換する
+            _, y_out, out_rate = next(cog._resample_rates(y, sample_rate, [rate]))
+            head = np.max(np.abs(y_out[0, :EDGE_CHECK_SAMPLES]))
+            tail = np.max(np.abs(y_out[1, -EDGE_CHECK_SAMPLES:]))
+            passed = head < EDGE_TOLERANCE and tail < EDGE_TOLERANCE
+            ok = ok and passed
+            print(f"{sample_rate:>10} {rate:>8.3f} {head:>8.3f} {tail:>8.3f}{'' if passed else '  <- NG'}")
+    return ok
+
+
+def legacy_render(y, rate):
+    """変更前の方法: サンプルレートを書き換えてffmpegでMP3に出力する (比較用)"""
+    pcm = np.ascontiguousarray((np.clip(y, -1.0, 1.0) * 32767).astype('<i2').T)
+    sound = AudioSegment(data=pcm.tobytes(), sample_width=2, frame_rate=SAMPLE_RATE, channels=y.shape[0])
+    new_sound = sound._spawn(sound.raw_data, overrides={"frame_rate": int(SAMPLE_RATE * rate)})
+    output_buffer = io.BytesIO()
+    new_sound.export(output_buffer, format="mp3", bitrate="192k")
+    return output_buffer.getvalue()
+
+
+def check_throughput(cog, rates, seconds, with_encode):
+    """ステレオのノイズ信号を全レートで変換し、処理速度を表示する"""
+    rng = np.random.default_rng(0)
+    y = (rng.standard_normal((2, SAMPLE_RATE * seconds)) * 0.1).astype(np.float32)
+    total_audio_seconds = seconds * len(rates)
+
+    print("--- 速度 ---")
+    start = time.perf_counter()
+    for _ in cog._resample_rates(y, SAMPLE_RATE, rates):
+        pass
+    elapsed = time.perf_counter() - start
+    print(f"リサンプルのみ: {elapsed:.2f} 秒 ({total_audio_seconds / elapsed:.1f} 倍速)")
+
+    if with_encode:
+        start = time.perf_counter()
+        for rate, mp3_bytes, error in cog._render_audio(y, SAMPLE_RATE, rates, no_pitch=False):
+            if error is not None:
+                raise error
+        elapsed = time.perf_counter() - start
+        print(f"リサンプル + MP3出力: {elapsed:.2f} 秒 ({total_audio_seconds / elapsed:.1f} 倍速)")
+
+        start = time.perf_counter()
+        for rate in rates:
+            legacy_render(y, rate)
+        elapsed = time.perf_counter() - start
+        print(f"従来の方法 (ffmpeg): {elapsed:.2f} 秒 ({total_audio_seconds / elapsed:.1f} 倍速)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="リサンプラーの精度・速度のベンチマーク")
+    parser.add_argument("--seconds", type=int, default=180, help="速度計測に使う信号の長さ (秒)")
+    parser.add_argument("--rates", type=float, nargs="+", default=[0.8, 1.05, 1.1, 1.2, 4 / 3, 1.5, 2.0], help="変換するレート")
+    parser.add_argument("--with-encode", action="store_true", help="MP3出力まで含めて従来の方法と比較する (ffmpegが必要)")
+    args = parser.parse_args()
+
+    cog = MalodyCog(None)
+    check_accuracy(cog, args.rates)
+    edges_ok = check_edges(cog, args.rates + [2.55, 3.0])
+    check_throughput(cog, args.rates, args.seconds, args.with_encode)
+    if not edges_ok:
+        print("エラー: 出力の先頭または末尾に曲の反対側のサンプルが混ざっています。")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,27 +6,213 @@ import json
 import zipfile
 import io
 import re
+import contextlib
+import collections
+import asyncio
+import threading
 import os
+import mmap
+import shutil
+import uuid
+import aiohttp # 添付ファイルのストリーミングダウンロード用
 from pydub import AudioSegment
 import traceback
 import requests
 import time
 import librosa # ピッチ維持のタイムストレッチに必要
 import numpy as np # librosaのデータ処理に必要
-import soundfile # タイムストレッチ後の音声書き出しに必要
+from numpy.lib.stride_tricks import sliding_window_view
+from fractions import Fraction
+from concurrent.futures import ThreadPoolExecutor
+import soundfile # WAV/OGG/FLACのデコードに必要
+
+import profiling # /profile によるオーナー用のプロファイル
 
 # 一時ファイルを保存するディレクトリ名を定義
 TEMP_DIR = "temp_audio"
 # Discordのファイルサイズ上限 (無料枠は8MB (8 * 1024 * 1024 = 8388608 bytes))
 DISCORD_FILE_LIMIT = 8388608 
+# 添付ファイルのダウンロード・ZIPメンバーのコピー時のチャンクサイズ (1MB)
+ATTACHMENT_CHUNK_SIZE = 1024 * 1024
+# ストリーミング送信で、送信待ちにできるパートの数 (これ以上溜まるとレンダリングを待たせる)
+STREAM_QUEUE_SIZE = 2
+# soundfile (libsndfile) でffmpegを使わずに直接デコードできる音声形式
+SOUNDFILE_FORMATS = ('wav', 'ogg', 'flac')
+# ピッチ変更モードの出力サンプルレート (入力がこれ以外の場合は DEFAULT_OUTPUT_SAMPLE_RATE に変換する)
+STANDARD_SAMPLE_RATES = (22050, 32000, 44100, 48000)
+DEFAULT_OUTPUT_SAMPLE_RATE = 44100
+# 窓付きsincリサンプラーの設定
+RESAMPLE_HALF_WIDTH = 16 # 片側のゼロ交差数 (大きいほど高品質・低速)
+RESAMPLE_OVERSAMPLE = 512 # sincテーブルの1サンプルあたりの分割数
+RESAMPLE_KAISER_BETA = 8.6 # Kaiser窓のβ (阻止域の減衰量 約 -90dB)
+RESAMPLE_ROLLOFF = 0.945 # カットオフ周波数 (ナイキスト周波数に対する比、遷移帯域をナイキスト未満に収める)
+RESAMPLE_MAX_PHASES = 4096 # レートを分数で近似する際の分母の上限 (位相ごとの重みテーブルの行数)
+RESAMPLE_BLOCK_SIZE = 16384 # 一度に計算する出力サンプル数 (メモリ使用量の上限)
+
+# !malody ジョブ全体で使ってよいメモリの上限 (見積もりの合計がこれを超えないよう、ジョブを待たせる・同時に処理するレート数を減らす)
+MEMORY_BUDGET_BYTES = int(os.getenv("MALODY_MEMORY_BUDGET_MB", "1024")) * 1024 * 1024
+# 1つのジョブ内で同時に処理するレート数の上限
+MAX_PARALLEL_RATES = int(os.getenv("MALODY_MAX_PARALLEL_RATES", str(min(4, os.cpu_count() or 1))))
+# メモリ使用量の見積もりに使う係数 (デコード後の1サンプル・1チャンネルあたりのバイト数)
+DECODED_BYTES_PER_SAMPLE = 4 # float32
+RESAMPLE_BYTES_PER_SAMPLE = 10 # 出力のfloat32 + MP3エンコード用のint16 PCMとpydub/ffmpegへの受け渡し
+STRETCH_BYTES_PER_SAMPLE = 48 # librosaのSTFT行列 (complex64) と位相ボコーダーの作業領域
+ENCODED_BYTES_PER_SECOND = 192000 // 8 * 2 # 192kbpsのMP3 (出力ZIPとストリーミング送信待ちの2つ分)
+MP3_ASSUMED_BYTES_PER_SECOND = 128000 // 8 # MP3など長さが分からない音声のビットレートの仮定値
+# 実測値による見積もりの補正 (指数移動平均の重みと、補正係数の範囲)
+MEMORY_CALIBRATION_WEIGHT = 0.3
+MEMORY_CALIBRATION_RANGE = (0.5, 4.0)
+MEMORY_HISTORY_SIZE = 50 # 保持するジョブごとの実測記録の数
+MEMORY_SAMPLE_INTERVAL = 0.05 # 実測時にメモリ使用量を調べる間隔 (秒)
+
+class _SeekableMmap(mmap.mmap):
+    """zipfileから直接読めるように seekable() を追加したmmap (Python 3.13未満のmmapには無い)"""
+    def seekable(self):
+        return True
+
+class _MemoryBudget:
+    """
+    !malody ジョブのメモリ使用量の見積もりを、全体の上限 (バイト) に収まるように割り当てる
+    先に待っているジョブから順に割り当てる (大きなジョブが小さなジョブに追い越され続けないように)
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self._active = [] # 実行中のジョブの割り当て
+        self._waiting = collections.deque()
+        self._condition = asyncio.Condition()
+
+    def can_start(self, base_bytes, per_rate_bytes):
+        """待たずにすぐ開始できるかどうか"""
+        return not self._waiting and self._fits(base_bytes + per_rate_bytes)
+
+    def _fits(self, nbytes):
+        # 1レートずつでも上限を超えるジョブは、他のジョブがすべて終わってから単独で実行する
+        return not self._active or self.in_use + nbytes <= self.limit
+
+    async def acquire(self, base_bytes, per_rate_bytes, max_parallel):
+        """
+        base_bytes + 並列数 × per_rate_bytes が上限に収まるまで待ってから割り当てる
+        空きが少ない場合は並列数 (同時に処理するレート数) を減らして割り当てる
+        :return: 割り当ての辞書 ("bytes", "parallel", "overlapped")
+        """
+        ticket = object()
+        async with self._condition:
+            self._waiting.append(ticket)
+            try:
+                await self._condition.wait_for(
+                    lambda: self._waiting[0] is ticket and self._fits(base_bytes + per_rate_bytes)
+                )
+            finally:
+                self._waiting.remove(ticket)
+                self._condition.notify_all()
+
+            available = self.limit - self.in_use
+            parallel = max_parallel
+            if per_rate_bytes > 0:
+                parallel = max(1, min(max_parallel, (available - base_bytes) // per_rate_bytes))
+            reservation = {
+                "bytes": min(base_bytes + parallel * per_rate_bytes, available),
+                "parallel": parallel,
+                # 他のジョブと同時に実行された場合、実測値はそのジョブの分も含む
+                "overlapped": bool(self._active),
+            }
+            for other in self._active:
+                other["overlapped"] = True
+            self._active.append(reservation)
+            self.in_use += reservation["bytes"]
+            return reservation
+
+    async def release(self, reservation):
+        """割り当てを返却し、待っているジョブを起こす"""
+        async with self._condition:
+            self._active.remove(reservation)
+            self.in_use -= reservation["bytes"]
+            self._condition.notify_all()
+
+class _PeakMemorySampler:
+    """ジョブの実行中にプロセスのメモリ使用量 (RSS) を定期的に調べ、開始時からの最大増加量を記録する"""
+    def __init__(self, interval=MEMORY_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.baseline = None
+        self.peak = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _current_rss(self):
+        # Linuxの /proc から現在のRSSを読む (それ以外の環境では計測しない)
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def start(self):
+        self.baseline = self._current_rss()
+        if self.baseline is None:
+            return
+        self.peak = self.baseline
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            rss = self._current_rss()
+            if rss is not None and rss > self.peak:
+                self.peak = rss
+
+    def stop(self):
+        """計測を止め、開始時からの最大増加量 (バイト) を返す (計測できない環境ではNone)"""
+        if self._thread is None:
+            return None
+        self._stop_event.set()
+        self._thread.join()
+        return max(0, self.peak - self.baseline)
 
 class MalodyCog(commands.Cog):
     """Malodyの譜面レート差分を生成するCog"""
     def __init__(self, bot):
         self.bot = bot
         os.makedirs(TEMP_DIR, exist_ok=True)
+        self.http_session = None
+        # !malody ジョブのメモリ割り当てと、見積もりの補正係数 (実測値から更新する)
+        self.memory_budget = _MemoryBudget(MEMORY_BUDGET_BYTES)
+        self.memory_calibration = 1.0
+        self.memory_history = collections.deque(maxlen=MEMORY_HISTORY_SIZE)
         print("- malody_cog.py を読み込みました。")
 
+    async def cog_load(self):
+        # aiohttpのセッションはイベントループ上で初期化する
+        # (__init__ では作らないので、ボットなしでも譜面処理のメソッドを使える)
+        self.http_session = aiohttp.ClientSession()
+
+    async def cog_unload(self):
+        # Cogがアンロードされるときにセッションを閉じる
+        if self.http_session is not None:
+            await self.http_session.close()
+
+    # -----------------------------------------------------------------
+    # 添付ファイルの読み込み
+    # -----------------------------------------------------------------
+    async def _download_attachment(self, attachment):
+        """
+        添付ファイルをチャンク単位で一時ファイルに書き出し、そのパスを返す
+        (attachment.read() と違い、ファイル全体をメモリに載せない)
+        """
+        temp_filepath = os.path.join(TEMP_DIR, f"{uuid.uuid4()}.mcz")
+        try:
+            async with self.http_session.get(attachment.url) as resp:
+                resp.raise_for_status()
+                with open(temp_filepath, 'wb') as f:
+                    async for chunk in resp.content.iter_chunked(ATTACHMENT_CHUNK_SIZE):
+                        f.write(chunk)
+        except Exception:
+            if os.path.exists(temp_filepath):
+                try: os.remove(temp_filepath)
+                except OSError as e: print(f"Error deleting file {temp_filepath}: {e}")
+            raise
+        return temp_filepath
+
     # -----------------------------------------------------------------
     # Litterbox アップロード機能
     # -----------------------------------------------------------------
@@ -155,63 +341,578 @@ class MalodyCog(commands.Cog):
 
         return new_data
 
-    def _process_audio(self, audio_bytes, audio_format, rate, no_pitch: bool):
+    def _decode_audio(self, audio_bytes, audio_format):
         """
-        pydub/librosaを使って音声の速度を変更し、MP3にエンコードする
-        no_pitch=True の場合は librosa を使ってタイムストレッチ（ピッチ維持）
-        no_pitch=False の場合は pydub を使ってリサンプル（ピッチ変更）
+        音声をfloat32のNumpy配列 (チャンネル数, サンプル数) にデコードする
+        WAV/OGG/FLACはsoundfileでメモリから直接読み込み、
+        MP3やsoundfileで読めない形式の場合のみffmpeg (pydub) を使う
+        :return: (y, sample_rate)
         """
+        if audio_format in SOUNDFILE_FORMATS:
+            try:
+                data, sample_rate = soundfile.read(io.BytesIO(audio_bytes), dtype='float32', always_2d=True)
+                y = np.ascontiguousarray(data.T) # (n_samples, n_channels) -> (n_channels, n_samples)
+                if y.shape[1] == 0:
+                    raise ValueError("無音の音声ファイル、または読み込みに失敗したため処理できません。")
+                return y, sample_rate
+            except Exception as e:
+                print(f"soundfileでのデコードに失敗したため、ffmpegで再試行します (形式: {audio_format}): {e}")
+
+        return self._decode_audio_ffmpeg(audio_bytes, audio_format)
+
+    def _decode_audio_ffmpeg(self, audio_bytes, audio_format):
+        """ffmpeg (pydub) を使って音声をfloat32のNumpy配列 (チャンネル数, サンプル数) にデコードする"""
         try:
             sound = AudioSegment.from_file(io.BytesIO(audio_bytes), format=audio_format)
         except Exception as e:
             try:
                 sound = AudioSegment.from_file(io.BytesIO(audio_bytes))
             except Exception as e2:
-                raise ValueError(f"音声ファイルの読み込みに失敗しました (形式: {audio_format})。\nOggやWavの場合、正しく処理できないことがあります。\n詳細: {e2}")
+                raise ValueError(f"音声ファイルの読み込みに失敗しました (形式: {audio_format})。\n詳細: {e2}")
 
         if not sound.raw_data:
             raise ValueError("無音の音声ファイル、または読み込みに失敗したため処理できません。")
 
+        # Numpyで直接扱えない8bit/24bitは16bitに揃える
+        if sound.sample_width not in (2, 4):
+            sound = sound.set_sample_width(2)
+        samples = np.frombuffer(sound.raw_data, dtype=f"<i{sound.sample_width}")
+        y = samples.astype(np.float32) / (1 << (sound.sample_width * 8 - 1))
+        y = np.ascontiguousarray(y.reshape((-1, sound.channels)).T) # インターリーブ -> (n_channels, n_samples)
+        return y, sound.frame_rate
+
+    def _encode_mp3(self, y, sample_rate):
+        """float32のNumpy配列 (チャンネル数, サンプル数) をMP3にエンコードする"""
+        pcm = (np.clip(y, -1.0, 1.0) * 32767).astype('<i2')
+        pcm = np.ascontiguousarray(pcm.T) # (n_channels, n_samples) -> インターリーブ
+        sound = AudioSegment(data=pcm.tobytes(), sample_width=2, frame_rate=sample_rate, channels=y.shape[0])
         output_buffer = io.BytesIO()
+        sound.export(output_buffer, format="mp3", bitrate="192k")
+        return output_buffer.getvalue()
 
-        if no_pitch:
-            # --- ピッチを維持する (librosa タイムストレッチ) ---
-            try:
-                # 1. pydubからNumpy配列に変換
-                y = np.array(sound.get_array_of_samples()).astype(np.float32) / (1 << (sound.sample_width * 8 - 1))
-                if sound.channels == 2:
-                    y = y.reshape((-1, 2)).T # (n_samples, 2) -> (2, n_samples) [librosa形式]
+    def _sinc_table(self):
+        """
+        Kaiser窓付きsinc関数のテーブルを作成する
+        距離 0 ～ RESAMPLE_HALF_WIDTH を1サンプルあたり RESAMPLE_OVERSAMPLE 分割した値 (それ以降は0)
+        """
+        x = np.arange((RESAMPLE_HALF_WIDTH + 2) * RESAMPLE_OVERSAMPLE + 2) / RESAMPLE_OVERSAMPLE
+        ratio = np.clip(1.0 - (x / RESAMPLE_HALF_WIDTH) ** 2, 0.0, None)
+        window = np.i0(RESAMPLE_KAISER_BETA * np.sqrt(ratio)) / np.i0(RESAMPLE_KAISER_BETA)
+        table = np.sinc(x) * window
+        table[x >= RESAMPLE_HALF_WIDTH] = 0.0
+        return table.astype(np.float32)
+
+    def _resample_step(self, sample_rate, rate, out_rate):
+        """
+        出力1サンプルあたりに進む入力サンプル数を分数 up/down で近似する
+        (down 個の出力ごとに同じ位相が繰り返されるので、重みを位相ごとに1回だけ計算すればよい)
+        """
+        return Fraction(sample_rate * rate / out_rate).limit_denominator(RESAMPLE_MAX_PHASES)
+
+    def _resample_filter(self, step):
+        """
+        リサンプルのカットオフ (入力のナイキスト周波数に対する比) と片側のタップ数
+        速くする場合はエイリアシングを防ぐため、カットオフを出力のナイキスト周波数に合わせて下げる
+        :return: (cutoff, half_taps)
+        """
+        cutoff = min(1.0, 1 / step) * RESAMPLE_ROLLOFF
+        return cutoff, int(np.ceil(RESAMPLE_HALF_WIDTH / cutoff))
+
+    def _prepare_resample(self, y, sample_rate, rates):
+        """
+        _resample_one で全レートが共有する、パディング済みの入力とsincテーブルを作成する
+        """
+        out_rate = sample_rate if sample_rate in STANDARD_SAMPLE_RATES else DEFAULT_OUTPUT_SAMPLE_RATE
+        n_channels, n_in = y.shape
+
+        # 最も速いレートのフィルタ長 (_resample_one と同じ計算) に合わせて前後をゼロで埋める
+        # (0以下のレートは _resample_one がエラーにするので除外する)
+        max_half_taps = max(
+            (self._resample_filter(self._resample_step(sample_rate, rate, out_rate))[1] for rate in rates if rate > 0),
+            default=RESAMPLE_HALF_WIDTH,
+        )
+        pad = max_half_taps + 1
+        y_padded = np.zeros((n_channels, n_in + 2 * pad), dtype=np.float32)
+        y_padded[:, pad:pad + n_in] = y
+
+        return {
+            "y": y,
+            "y_padded": y_padded,
+            "pad": pad,
+            "table": self._sinc_table(),
+            "sample_rate": sample_rate,
+            "out_rate": out_rate,
+        }
+
+    def _resample_one(self, prepared, rate):
+        """
+        _prepare_resample で準備した入力を1つのレートでリサンプルする
+        (入力は読み取り専用なので、複数のレートを別スレッドで同時に処理できる)
+        :return: (y_out, out_rate)
+        """
+        y, y_padded, pad, table = prepared["y"], prepared["y_padded"], prepared["pad"], prepared["table"]
+        sample_rate, out_rate = prepared["sample_rate"], prepared["out_rate"]
+        n_channels, n_in = y.shape
+        table_limit = len(table) - 2
+        if rate <= 0:
+            raise ValueError(f"レートは0より大きい必要があります (レート: {rate})。")
+
+        step = self._resample_step(sample_rate, rate, out_rate)
+        up, down = step.numerator, step.denominator
+        n_out = int(n_in * down / up)
+
+        if up == down:
+            # 1.0倍 (ソフラン除去のみ) でサンプルレートも同じ場合はそのまま
+            return y.copy(), out_rate
+
+        cutoff, half_taps = self._resample_filter(step)
+        # パディングが足りないと、先頭のサンプルが負のインデックス (曲の末尾) を参照してしまう
+        assert half_taps < pad, f"リサンプルのパディングが不足しています (taps={half_taps}, pad={pad})"
+        offsets = np.arange(-half_taps + 1, half_taps + 1)
+
+        # 位相ごとのタップの重み (テーブルを線形補間) (down, taps)
+        frac = (np.arange(down) * up % down) / down
+        position = np.abs(frac[:, np.newaxis] - offsets[np.newaxis, :]) * (cutoff * RESAMPLE_OVERSAMPLE)
+        index = np.minimum(position.astype(np.int64), table_limit)
+        phase_weights = table[index] + (table[index + 1] - table[index]) * (position - index)
+        phase_weights /= phase_weights.sum(axis=1, keepdims=True) # 直流成分のゲインを1に揃える
+        phase_weights = phase_weights.astype(np.float32)
+
+        # windows[:, i] は入力の (i - pad + offsets[0]) 番目からの taps サンプル (コピーなしのビュー)
+        windows = sliding_window_view(y_padded, len(offsets), axis=1)
+        y_out = np.empty((n_channels, n_out), dtype=np.float32)
+
+        for block_start in range(0, n_out, RESAMPLE_BLOCK_SIZE):
+            block_end = min(block_start + RESAMPLE_BLOCK_SIZE, n_out)
+            k = np.arange(block_start, block_end, dtype=np.int64)
+            base = k * up // down # 各出力サンプルの直前の入力サンプル
+            taps = windows[:, base + pad + offsets[0]] # (channels, block, taps)
+            y_out[:, block_start:block_end] = np.einsum('cbt,bt->cb', taps, phase_weights[k % down])
+
+        return y_out, out_rate
+
+    def _resample_rates(self, y, sample_rate, rates):
+        """
+        デコード済みの音声から、各レートで速度変更（ピッチ変更）した信号を順に生成する
+        入力を sample_rate * rate で再生したものとみなし、標準のサンプルレートへ
+        窓付きsinc補間 (ポリフェーズ) でリサンプルする
+        パディング済みの入力とsincテーブルは全レートで共有する
+        :return: (rate, y_out, out_rate) を返すジェネレーター
+        """
+        prepared = self._prepare_resample(y, sample_rate, rates)
+        for rate in rates:
+            y_out, out_rate = self._resample_one(prepared, rate)
+            yield rate, y_out, out_rate
+
+    def _time_stretch(self, y, rate):
+        """librosaを使ってピッチを維持したまま速度を変更する"""
+        try:
+            # モノラルは1次元、ステレオは (2, n_samples) [librosa形式]
+            y_in = y[0] if y.shape[0] == 1 else y
+            y_stretched = librosa.effects.time_stretch(y=y_in, rate=rate)
+            if y_stretched.ndim == 1:
+                y_stretched = y_stretched[np.newaxis, :]
+            return y_stretched
+        except Exception as e:
+            print(f"Librosa タイムストレッチエラー: {e}")
+            print(traceback.format_exc())
+            raise ValueError(f"ピッチ維持（タイムストレッチ）の変換に失敗しました。\n詳細: {e}")
+
+    def _render_audio(self, y, sample_rate, rates, no_pitch: bool, parallel=1):
+        """
+        デコード済みの音声 (_decode_audio の戻り値) から、各レートのMP3を順に生成する
+        no_pitch=True の場合は librosa を使ってタイムストレッチ（ピッチ維持）
+        no_pitch=False の場合は _resample_one でリサンプル（ピッチ変更）
+        :param parallel: 同時に処理するレートの数 (メモリ使用量は概ねこの数に比例する)
+        :return: (rate, mp3_bytes, error) を返すジェネレーター (失敗したレートは mp3_bytes=None)
+        """
+        # ピッチ変更モードでは、パディング済みの入力をバッチ内の全レートで共有する
+        prepared = None if no_pitch else self._prepare_resample(y, sample_rate, rates)
+
+        def render_one(rate):
+            if no_pitch:
+                # --- ピッチを維持する (librosa タイムストレッチ) ---
+                return self._encode_mp3(self._time_stretch(y, rate), sample_rate)
+            # --- ピッチも変更する (窓付きsincリサンプル) ---
+            y_out, out_rate = self._resample_one(prepared, rate)
+            return self._encode_mp3(y_out, out_rate)
+
+        parallel = max(1, parallel)
+        render_one = profiling.wrap(render_one)
+        with ThreadPoolExecutor(max_workers=parallel) as pool:
+            # parallel 個ずつのバッチに分け、バッチ内のレートを同時に処理する
+            for batch_start in range(0, len(rates), parallel):
+                batch = rates[batch_start:batch_start + parallel]
+                futures = [pool.submit(render_one, rate) for rate in batch]
+                for rate, future in zip(batch, futures):
+                    try:
+                        yield rate, future.result(), None
+                    except Exception as e:
+                        yield rate, None, e
+
+    # -----------------------------------------------------------------
+    # 譜面パックの処理 (!malody コマンドと malody_batch.py で共通)
+    # -----------------------------------------------------------------
+
+    def _parse_malody_args(self, args):
+        """
+        !malody の引数をパースしてオプションの辞書を返す
+        引数が正しくない場合は ValueError を送出する
+        """
+        rates_to_generate = []
+        desofflan = False
+        desofflan_only = False
+        target_bpms = []
+        is_bpm_mode = False
+        no_pitch = False # ピッチ維持フラグ
+        stream_batch_size = 0 # 0 = ストリーミング送信なし
+
+        i = 0
+        while i < len(args):
+            arg = args[i].lower()
+            if arg == "--desofflan":
+                desofflan = True
+                i += 1
+            elif arg == "--desofflan-only":
+                desofflan_only = True
+                desofflan = True
+                i += 1
+            elif arg in ("--no-pitch", "-np"): # <-- NEW
+                no_pitch = True
+                i += 1
+            elif arg in ("--stream", "-s"):
+                stream_batch_size = max(stream_batch_size, 1)
+                i += 1
+            elif arg == "--stream-batch":
+                if i + 1 >= len(args): raise ValueError("--stream-batch には1つの引数（個数）が必要です。")
+                stream_batch_size = int(args[i+1])
+                if stream_batch_size <= 0: raise ValueError("--stream-batch の個数は1以上である必要があります。")
+                i += 2
+            elif arg == "--range":
+                if i + 3 >= len(args): raise ValueError("--range には3つの引数（開始, 終了, 刻み幅）が必要です。")
+                start, end, step = float(args[i+1]), float(args[i+2]), float(args[i+3])
+                if step <= 0: raise ValueError("刻み幅は0より大きい必要があります。")
+                r = start
+                while r <= end + 1e-9:
+                    rates_to_generate.append(r)
+                    r += step
+                i += 4
+            elif arg == "--bpm":
+                is_bpm_mode = True
+                i += 1
+                if i >= len(args) or args[i].startswith("--"): raise ValueError("--bpm には少なくとも1つのBPM値を指定が必要です。")
+                while i < len(args) and not args[i].startswith("--"):
+                    target_bpms.append(float(args[i]))
+                    i += 1
+            else:
+                rates_to_generate.append(float(arg))
+                i += 1
+        
+        if not rates_to_generate and not target_bpms and not desofflan_only:
+            raise ValueError("レート、BPM、または `--desofflan-only` のいずれかを指定してください。")
+        if desofflan_only:
+            rates_to_generate.append(1.0) # ソフラン除去のみ
+
+        return {
+            "rates": rates_to_generate,
+            "target_bpms": target_bpms,
+            "is_bpm_mode": is_bpm_mode,
+            "desofflan": desofflan,
+            "no_pitch": no_pitch,
+            "stream_batch_size": stream_batch_size,
+        }
+
+    @contextlib.contextmanager
+    def _open_pack(self, zip_path):
+        """譜面パックのファイルをメモリマップで開く (必要なメンバーだけを読み出す)"""
+        with open(zip_path, 'rb') as input_file, \
+             _SeekableMmap(input_file.fileno(), 0, access=mmap.ACCESS_READ) as input_mmap, \
+             zipfile.ZipFile(input_mmap, 'r') as in_zip:
+            yield in_zip
+
+    def _scan_pack(self, in_zip):
+        """
+        譜面パック内のファイルを分類する
+        譜面 (.mc) はここでJSONとして読み込み、音声は譜面から参照された時にだけ読み込む
+        :return: (charts_to_process, audio_members, original_members, warnings)
+        """
+        charts_to_process = []
+        audio_members = {} # audio_name: ZipInfo
+        original_members = [] # 元のファイルのZipInfo
+        warnings = []
+
+        for item in in_zip.infolist():
+            if item.is_dir():
+                continue
+            
+            file_name = item.filename
+            if file_name.startswith("__MACOSX/"):
+                continue
                 
-                # 2. タイムストレッチ実行
-                y_stretched = librosa.effects.time_stretch(y=y, rate=rate)
+            original_members.append(item) # すべての元のファイルを記録
+
+            if file_name.lower().endswith(".mc"):
+                try:
+                    chart_data = json.loads(in_zip.read(item).decode('utf-8'))
+                except Exception as e:
+                    warnings.append(f"警告: 譜面ファイル `{file_name}` はJSONとして解析できませんでした。スキップします。\n`{e}`")
+                    continue
+                    
+                audio_file_name = chart_data.get("meta", {}).get("song", {}).get("audio")
+                if not audio_file_name:
+                    for note in chart_data.get("note", []):
+                        if note.get("sound"):
+                            audio_file_name = note["sound"]
+                            break
                 
-                # 3. 一時WAVファイルとしてメモリに書き出す
-                temp_wav_buffer = io.BytesIO()
-                # soundfileは (n_samples, n_channels) 形式を期待
-                if y_stretched.ndim == 2:
-                    y_stretched_sf = y_stretched.T # (2, n_samples) -> (n_samples, 2)
+                original_bpm = 0
+                if chart_data.get("time") and len(chart_data["time"]) > 0:
+                    original_bpm = chart_data["time"][0].get("bpm", 0)
+
+                charts_to_process.append({
+                    "name": file_name,
+                    "data": chart_data,
+                    "audio_name": audio_file_name,
+                    "original_bpm": original_bpm
+                })
+            
+            elif file_name.lower().endswith(('.mp3', '.ogg', '.wav', '.flac')):
+                audio_members[file_name] = item
+
+        return charts_to_process, audio_members, original_members, warnings
+
+    def _copy_original_members(self, in_zip, out_zip, original_members):
+        """元のファイルをすべて出力ZIPにチャンク単位でコピーする"""
+        for item in original_members:
+            with in_zip.open(item) as src, out_zip.open(item.filename, 'w') as dst:
+                shutil.copyfileobj(src, dst, ATTACHMENT_CHUNK_SIZE)
+
+    def _compute_final_rates(self, charts_to_process, options):
+        """
+        指定されたレート・BPMから生成するレートの一覧を作成する
+        :return: (final_rates, warnings)
+        """
+        final_rates = set()
+        warnings = []
+        if options["is_bpm_mode"]:
+            for chart in charts_to_process:
+                if chart["original_bpm"] > 0:
+                    for bpm in options["target_bpms"]:
+                        final_rates.add(bpm / chart["original_bpm"])
                 else:
-                    y_stretched_sf = y_stretched
+                    warnings.append(f"警告: 譜面 `{chart['name']}` のBPMが不明なため、BPM指定の差分を作成できません。")
+        final_rates.update(options["rates"])
+        
+        if not final_rates:
+            raise ValueError("有効なレートが生成されませんでした。")
+
+        return sorted(list(final_rates)), warnings
+
+    def _iter_variants(self, in_zip, charts_to_process, audio_members, final_rates, desofflan, no_pitch, parallel=1):
+        """
+        譜面ごとに音源をデコードし、各レートの差分を順に生成する
+        重い処理なので、呼び出し側は next() を別スレッド・別プロセスで実行する
+        :param parallel: 同時に処理するレートの数 (_render_audio を参照)
+        :return: ("variant", 差分の辞書) または ("warning", メッセージ) を返すジェネレーター
+        """
+        loaded_audio_name = None # 直前にデコードした音源 (同じ音源を使う譜面で再利用する)
+        decoded_audio = None # (y, sample_rate)
+
+        for chart in charts_to_process:
+            if not chart["audio_name"] or chart["audio_name"] not in audio_members:
+                yield "warning", f"警告: 譜面 `{chart['name']}` に対応する音源 `{chart['audio_name']}` が見つからないため、スキップします。"
+                continue
+            
+            if chart["audio_name"] != loaded_audio_name:
+                decoded_audio = None # 前の音源を解放してから読み込む
+                loaded_audio_name = None
+                audio_format = chart["audio_name"].rsplit('.', 1)[-1].lower()
+                try:
+                    # 音源はレートごとではなく譜面の音源ごとに1回だけデコードする
+                    decoded_audio = self._decode_audio(in_zip.read(audio_members[chart["audio_name"]]), audio_format)
+                except Exception as decode_e:
+                    print(traceback.format_exc())
+                    yield "warning", f"警告: 譜面 `{chart['name']}` の音源 `{chart['audio_name']}` を読み込めなかったため、スキップします。\n`{decode_e}`"
+                    continue
+                loaded_audio_name = chart["audio_name"]
+            y, sample_rate = decoded_audio
+            
+            # 1.0倍かつソフラン除去なしの差分はスキップ (元ファイルが既にあるため)
+            chart_rates = [rate for rate in final_rates if not (abs(rate - 1.0) < 1e-9 and not desofflan)]
+            if not chart_rates:
+                continue
+
+            base_chart_data = self._desofflan(chart["data"]) if desofflan else chart["data"]
+
+            # 音声を処理 (no_pitchフラグを渡す)
+            for rate, new_audio_bytes, render_error in self._render_audio(y, sample_rate, chart_rates, no_pitch, parallel):
+                try:
+                    if render_error is not None:
+                        raise render_error
                     
-                soundfile.write(temp_wav_buffer, y_stretched_sf, sound.frame_rate, format='WAV')
-                temp_wav_buffer.seek(0)
-                
-                # 4. WAVをpydubで読み込み、MP3に変換
-                stretched_sound = AudioSegment.from_wav(temp_wav_buffer)
-                stretched_sound.export(output_buffer, format="mp3", bitrate="192k")
+                    new_audio_name = chart["audio_name"].rsplit('.', 1)[0] + f"_rate{rate:.3f}x.mp3"
+                    
+                    new_mc_data = self._process_mc_file(base_chart_data, rate, new_audio_name, desofflan, chart["original_bpm"])
+                    new_mc_name = chart["name"].rsplit('.', 1)[0] + f"_{'desofflan_' if desofflan else ''}rate{rate:.3f}x.mc"
+                    new_mc_bytes = json.dumps(new_mc_data, indent=2).encode('utf-8')
                 
+                except Exception as process_e:
+                    print(traceback.format_exc())
+                    yield "warning", f"警告: レート `{rate:.3f}x` の譜面 `{chart['name']}` の処理中にエラーが発生しました。スキップします。\n`{process_e}`"
+                    continue
+
+                yield "variant", {
+                    "rate": rate,
+                    "mc_name": new_mc_name,
+                    "mc_bytes": new_mc_bytes,
+                    "audio_name": new_audio_name,
+                    "audio_bytes": new_audio_bytes,
+                    "audio_seconds": y.shape[1] / sample_rate / rate,
+                }
+
+    # -----------------------------------------------------------------
+    # メモリ使用量の見積もり
+    # -----------------------------------------------------------------
+
+    def _probe_audio(self, in_zip, member):
+        """
+        音声をデコードせずに、フレーム数・チャンネル数・サンプルレートを調べる
+        soundfileで読めない形式 (MP3など) はファイルサイズから推定する
+        :return: (frames, channels, sample_rate)
+        """
+        audio_format = member.filename.rsplit('.', 1)[-1].lower()
+        if audio_format in SOUNDFILE_FORMATS:
+            try:
+                with in_zip.open(member) as f:
+                    info = soundfile.info(f)
+                return info.frames, info.channels, info.samplerate
             except Exception as e:
-                print(f"Librosa/Soundfile タイムストレッチエラー: {e}")
-                print(traceback.format_exc())
-                raise ValueError(f"ピッチ維持（タイムストレッチ）の変換に失敗しました。\n詳細: {e}")
-        
+                print(f"音声情報の取得に失敗したため、ファイルサイズから推定します ({member.filename}): {e}")
+
+        seconds = member.file_size / MP3_ASSUMED_BYTES_PER_SECOND
+        return int(seconds * DEFAULT_OUTPUT_SAMPLE_RATE), 2, DEFAULT_OUTPUT_SAMPLE_RATE
+
+    def _estimate_job_memory(self, in_zip, charts_to_process, audio_members, final_rates, no_pitch):
+        """
+        ジョブのピークメモリ使用量を、サンプル数・チャンネル数・レートの数から見積もる (補正係数は掛けない)
+        ピーク ≒ base_bytes + 同時に処理するレート数 × per_rate_bytes
+        :return: (base_bytes, per_rate_bytes)
+        """
+        # 出力ZIPには元のファイルがすべてコピーされる
+        base_bytes = sum(item.file_size for item in in_zip.infolist())
+        decoded_bytes = 0
+        per_rate_bytes = 0
+        probed = {} # audio_name: (frames, channels, sample_rate)
+        # 0以下のレートは差分を作らず警告になるだけなので、見積もりから除外する
+        valid_rates = [rate for rate in final_rates if rate > 0]
+        if not valid_rates:
+            return int(base_bytes), 0
+        slowest = min(valid_rates)
+
+        for chart in charts_to_process:
+            audio_name = chart["audio_name"]
+            if not audio_name or audio_name not in audio_members:
+                continue
+            if audio_name not in probed:
+                probed[audio_name] = self._probe_audio(in_zip, audio_members[audio_name])
+            frames, channels, sample_rate = probed[audio_name]
+            samples = frames * channels
+
+            # デコード済みの音声は同時に1つだけ保持する (ピッチ変更モードはパディング済みのコピーも)
+            decoded_bytes = max(decoded_bytes, samples * DECODED_BYTES_PER_SAMPLE * (1 if no_pitch else 2))
+
+            # 1レートあたりの作業領域 (遅くするほど出力が長くなる)
+            if no_pitch:
+                working = samples * STRETCH_BYTES_PER_SAMPLE * max(1.0, 1.0 / slowest)
+            else:
+                working = samples * RESAMPLE_BYTES_PER_SAMPLE / slowest
+            per_rate_bytes = max(per_rate_bytes, working)
+
+            # 完成した差分のMP3はすべて出力ZIPに残る
+            seconds = frames / sample_rate
+            base_bytes += sum(seconds / rate for rate in valid_rates) * ENCODED_BYTES_PER_SECOND
+
+        return int(base_bytes + decoded_bytes), int(per_rate_bytes)
+
+    def _record_memory_usage(self, pack_name, estimated_bytes, observed_bytes, reservation):
+        """
+        ジョブの見積もりと実測のピークメモリ使用量を記録し、見積もりの補正係数を更新する
+        他のジョブと同時に実行された場合は実測値に他のジョブの分が混ざるため、補正には使わない
+        """
+        self.memory_history.append({
+            "pack": pack_name,
+            "estimated_bytes": estimated_bytes,
+            "observed_bytes": observed_bytes,
+            "parallel": reservation["parallel"],
+            "overlapped": reservation["overlapped"],
+        })
+
+        observed_text = f"{observed_bytes / (1024*1024):.1f} MB" if observed_bytes is not None else "計測不可"
+        print(f"[malody] メモリ使用量 `{pack_name}`: 見積もり {estimated_bytes / (1024*1024):.1f} MB (補正前) / 実測 {observed_text} / 並列数 {reservation['parallel']}{' / 他のジョブと同時実行' if reservation['overlapped'] else ''}")
+
+        if observed_bytes is None or reservation["overlapped"] or estimated_bytes <= 0:
+            return
+        ratio = observed_bytes / estimated_bytes
+        calibration = (1 - MEMORY_CALIBRATION_WEIGHT) * self.memory_calibration + MEMORY_CALIBRATION_WEIGHT * ratio
+        self.memory_calibration = min(max(calibration, MEMORY_CALIBRATION_RANGE[0]), MEMORY_CALIBRATION_RANGE[1])
+
+    # -----------------------------------------------------------------
+    # ストリーミング送信
+    # -----------------------------------------------------------------
+
+    def _build_variant_zip(self, entries):
+        """
+        差分の譜面と音源だけを含む最小の.mczをメモリ上に作成する
+        :param entries: [(ファイル名, バイト列), ...]
+        """
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as variant_zip:
+            for file_name, file_bytes in entries:
+                variant_zip.writestr(file_name, file_bytes)
+        return buffer.getvalue()
+
+    async def _send_stream_batch(self, ctx, entries, original_zip_name, part_no):
+        """完成した差分を最小の.mczとしてすぐに送信する (--stream)"""
+        base_name = original_zip_name.rsplit('.', 1)[0]
+        if len(entries) == 2:
+            # 1差分のみの場合は譜面ファイル名をそのまま使う
+            variant_name = entries[0][0].rsplit('/', 1)[-1].rsplit('.', 1)[0]
+            part_name = f"{variant_name}.mcz"
         else:
-            # --- ピッチも変更する (pydub リサンプル - 従来の方法) ---
-            new_frame_rate = int(sound.frame_rate * rate)
-            new_sound = sound._spawn(sound.raw_data, overrides={"frame_rate": new_frame_rate})
-            new_sound.export(output_buffer, format="mp3", bitrate="192k")
+            part_name = f"{base_name}_part{part_no}.mcz"
 
-        return output_buffer.getvalue()
+        try:
+            loop = self.bot.loop
+            part_bytes = await loop.run_in_executor(None, profiling.wrap(self._build_variant_zip), entries)
+            if len(part_bytes) > DISCORD_FILE_LIMIT:
+                await ctx.send(f"警告: `{part_name}` はサイズが8MBを超えたため個別送信をスキップしました。最後のパックに含まれます。")
+                return
+            await ctx.reply(file=discord.File(io.BytesIO(part_bytes), filename=part_name))
+        except Exception as e:
+            # 個別送信に失敗しても最後のパックは作成する
+            print(f"ストリーミング送信エラー: {e}")
+            await ctx.send(f"警告: `{part_name}` の送信に失敗しました。最後のパックに含まれます。\n`{e}`")
+
+    async def _stream_sender(self, ctx, stream_queue, original_zip_name, processing_message):
+        """
+        キューに入った差分を順に送信する (--stream)
+        レンダリングと並行して実行し、送信中も次の差分の処理を止めない
+        キューに None が入ると終了する
+        """
+        part_no = 0
+        sent_variants = 0
+        while True:
+            entries = await stream_queue.get()
+            if entries is None:
+                return
+            part_no += 1
+            try:
+                await self._send_stream_batch(ctx, entries, original_zip_name, part_no)
+                sent_variants += len(entries) // 2
+                await processing_message.edit(content=f"処理中です... {sent_variants}差分を送信済みです。全差分をまとめたパックは最後に送信します。")
+            except Exception as e:
+                # 送信側のエラーでレンダリングや最後のパックの送信を止めない
+                print(f"ストリーミング送信エラー: {e}")
 
     # -----------------------------------------------------------------
     # Discordコマンド
@@ -249,13 +950,27 @@ class MalodyCog(commands.Cog):
     レートの代わりに、目標のBPMを指定します。
     譜面のBPMが150の場合、`--bpm 180 200`と指定すると、1.2倍と1.33倍の差分が作成されます。
     例: `!malody --bpm 180 200 --desofflan`
+
+    `--stream` または `-s`
+    差分が1つ完成するたびに、その譜面と音源だけを含む小さな.mczをすぐに送信します。
+    全差分をまとめたパックも最後に送信されます。
+    例: `!malody --range 1.05 1.5 0.05 --stream`
+
+    `--stream-batch [個数]`
+    `--stream` と同様ですが、指定した個数の差分ごとにまとめて送信します。
+    例: `!malody --range 1.05 1.5 0.05 --stream-batch 3`
     """
     )
     async def malody_command(self, ctx, *args):
         """
         添付された.mcz/.zip譜面のレート差分を生成します。
         """
-        
+        async with profiling.profile_command(self.bot, ctx, "malody"):
+            await self._run_malody_command(ctx, *args)
+
+    async def _run_malody_command(self, ctx, *args):
+        """!malody の本体 (/profile で有効にした場合はこの中がプロファイルされる)"""
+
         # --- 1. 引数と添付ファイルのバリデーション ---
         if not ctx.message.attachments:
             return await ctx.reply("エラー: `.mcz` または `.zip` ファイルを添付してください。")
@@ -265,176 +980,120 @@ class MalodyCog(commands.Cog):
             return await ctx.reply("エラー: 添付ファイルは `.mcz` または `.zip` である必要があります。")
 
         original_zip_name = attachment.filename
-        
-        try:
-            attachment_bytes = await attachment.read()
-        except Exception as e:
-            return await ctx.reply(f"エラー: 添付ファイルの読み込みに失敗しました。\n`{e}`")
 
         # --- 2. 引数のパース ---
-        rates_to_generate = []
-        desofflan = False
-        desofflan_only = False
-        target_bpms = []
-        is_bpm_mode = False
-        no_pitch = False # ピッチ維持フラグ
-
         try:
-            i = 0
-            while i < len(args):
-                arg = args[i].lower()
-                if arg == "--desofflan":
-                    desofflan = True
-                    i += 1
-                elif arg == "--desofflan-only":
-                    desofflan_only = True
-                    desofflan = True
-                    i += 1
-                elif arg in ("--no-pitch", "-np"): # <-- NEW
-                    no_pitch = True
-                    i += 1
-                elif arg == "--range":
-                    if i + 3 >= len(args): raise ValueError("--range には3つの引数（開始, 終了, 刻み幅）が必要です。")
-                    start, end, step = float(args[i+1]), float(args[i+2]), float(args[i+3])
-                    if step <= 0: raise ValueError("刻み幅は0より大きい必要があります。")
-                    r = start
-                    while r <= end + 1e-9:
-                        rates_to_generate.append(r)
-                        r += step
-                    i += 4
-                elif arg == "--bpm":
-                    is_bpm_mode = True
-                    i += 1
-                    if i >= len(args) or args[i].startswith("--"): raise ValueError("--bpm には少なくとも1つのBPM値を指定が必要です。")
-                    while i < len(args) and not args[i].startswith("--"):
-                        target_bpms.append(float(args[i]))
-                        i += 1
-                else:
-                    rates_to_generate.append(float(arg))
-                    i += 1
-            
-            if not rates_to_generate and not target_bpms and not desofflan_only:
-                raise ValueError("レート、BPM、または `--desofflan-only` のいずれかを指定してください。")
-            if desofflan_only:
-                rates_to_generate.append(1.0) # ソフラン除去のみ
-
+            options = self._parse_malody_args(args)
         except Exception as e:
             return await ctx.reply(f"エラー: コマンドの引数が正しくありません。\n`{e}`\n\n**使い方:** `!malody [レート/オプション] (譜面ファイルを添付)`\n**例:** `!malody 1.1 1.2 --desofflan`\n`!help malody` で詳細を確認できます。")
+        desofflan = options["desofflan"]
+        stream_batch_size = options["stream_batch_size"]
 
-        await ctx.message.add_reaction("⏳") # 処理中リアクション
-        processing_message = await ctx.reply(f"処理中です... `{original_zip_name}` を解析しています。")
+        try:
+            input_zip_path = await self._download_attachment(attachment)
+        except Exception as e:
+            return await ctx.reply(f"エラー: 添付ファイルの読み込みに失敗しました。\n`{e}`")
 
+        try:
+            await ctx.message.add_reaction("⏳") # 処理中リアクション
+            processing_message = await ctx.reply(f"処理中です... `{original_zip_name}` を解析しています。")
+        except Exception:
+            # 下の finally に入る前に失敗した場合も一時ファイルを残さない
+            if os.path.exists(input_zip_path):
+                try: os.remove(input_zip_path)
+                except OSError as e: print(f"Error deleting file {input_zip_path}: {e}")
+            raise
+
+        reservation = None # メモリの割り当て
+        memory_sampler = None
         try:
             # --- 3. メインのZIP処理 ---
-            input_zip_buffer = io.BytesIO(attachment_bytes)
-            output_zip_buffer = io.BytesIO()
+            # 一時ファイルをメモリマップで開き、必要なメンバーだけを読み出す
+            with self._open_pack(input_zip_path) as in_zip:
+                charts_to_process, audio_members, original_members, warnings = self._scan_pack(in_zip)
+                for warning in warnings:
+                    await ctx.send(warning)
+            
+                if not charts_to_process:
+                    raise ValueError("`.mcz` ファイル内に `.mc` 譜面ファイルが見つかりません。")
 
-            charts_to_process = []
-            audio_files = {} # audio_name: audio_bytes
-            original_files = {} # file_name: file_bytes
+                final_rates, warnings = self._compute_final_rates(charts_to_process, options)
+                for warning in warnings:
+                    await ctx.send(warning)
 
-            with zipfile.ZipFile(input_zip_buffer, 'r') as in_zip:
-                for item in in_zip.infolist():
-                    if item.is_dir():
-                        continue
-                    
-                    file_name = item.filename
-                    if file_name.startswith("__MACOSX/"):
-                        continue
-                        
-                    file_bytes = in_zip.read(file_name)
-                    original_files[file_name] = file_bytes # すべての元のファイルを保存
-
-                    if file_name.lower().endswith(".mc"):
-                        try:
-                            chart_data = json.loads(file_bytes.decode('utf-8'))
-                        except Exception as e:
-                            await ctx.send(f"警告: 譜面ファイル `{file_name}` はJSONとして解析できませんでした。スキップします。\n`{e}`")
-                            continue
-                            
-                        audio_file_name = chart_data.get("meta", {}).get("song", {}).get("audio")
-                        if not audio_file_name:
-                            for note in chart_data.get("note", []):
-                                if note.get("sound"):
-                                    audio_file_name = note["sound"]
-                                    break
-                        
-                        original_bpm = 0
-                        if chart_data.get("time") and len(chart_data["time"]) > 0:
-                            original_bpm = chart_data["time"][0].get("bpm", 0)
-
-                        charts_to_process.append({
-                            "name": file_name,
-                            "data": chart_data,
-                            "audio_name": audio_file_name,
-                            "original_bpm": original_bpm
-                        })
-                    
-                    elif file_name.lower().endswith(('.mp3', '.ogg', '.wav')):
-                        audio_files[file_name] = file_bytes
-            
-            if not charts_to_process:
-                raise ValueError("`.mcz` ファイル内に `.mc` 譜面ファイルが見つかりません。")
-
-            # --- 4. 出力ZIPの作成 ---
-            with zipfile.ZipFile(output_zip_buffer, 'w', zipfile.ZIP_DEFLATED) as out_zip:
-                # 最初に、元のファイルをすべて出力ZIPに書き込む
-                for file_name, file_bytes in original_files.items():
-                    out_zip.writestr(file_name, file_bytes)
-                
-                final_rates = set()
-                if is_bpm_mode:
-                    for chart in charts_to_process:
-                        if chart["original_bpm"] > 0:
-                            for bpm in target_bpms:
-                                final_rates.add(bpm / chart["original_bpm"])
-                        else:
-                            await ctx.send(f"警告: 譜面 `{chart['name']}` のBPMが不明なため、BPM指定の差分を作成できません。")
-                final_rates.update(rates_to_generate)
-                
-                if not final_rates:
-                    raise ValueError("有効なレートが生成されませんでした。")
+                # --- メモリ使用量を見積もり、全体の上限内で割り当てられるまで待つ ---
+                loop = self.bot.loop
+                raw_base_bytes, raw_per_rate_bytes = await loop.run_in_executor(
+                    None,
+                    profiling.wrap(self._estimate_job_memory),
+                    in_zip,
+                    charts_to_process,
+                    audio_members,
+                    final_rates,
+                    options["no_pitch"]
+                )
+                base_bytes = int(raw_base_bytes * self.memory_calibration)
+                per_rate_bytes = int(raw_per_rate_bytes * self.memory_calibration)
+                if not self.memory_budget.can_start(base_bytes, per_rate_bytes):
+                    await processing_message.edit(content=f"処理待ちです... 他の譜面を処理中のため、メモリに空きができるまで待機しています。(見積もり {(base_bytes + per_rate_bytes) / (1024*1024):.0f} MB)")
+                reservation = await self.memory_budget.acquire(base_bytes, per_rate_bytes, min(MAX_PARALLEL_RATES, len(final_rates)))
+                memory_sampler = _PeakMemorySampler()
+                memory_sampler.start()
 
-                final_rates = sorted(list(final_rates))
-                
-                await processing_message.edit(content=f"処理中です... {len(charts_to_process)}譜面 x {len(final_rates)}レート = 計{len(charts_to_process) * len(final_rates)}差分を生成します。")
-                
-                total_charts_processed = 0
-                
-                # --- 5. レートごとに譜面と音声を処理 ---
-                for chart in charts_to_process:
-                    if not chart["audio_name"] or chart["audio_name"] not in audio_files:
-                        await ctx.send(f"警告: 譜面 `{chart['name']}` に対応する音源 `{chart['audio_name']}` が見つからないため、スキップします。")
-                        continue
+                # --- 4. 出力ZIPの作成 ---
+                output_zip_buffer = io.BytesIO()
+                with zipfile.ZipFile(output_zip_buffer, 'w', zipfile.ZIP_DEFLATED) as out_zip:
+                    # 最初に、元のファイルをすべて出力ZIPに書き込む
+                    self._copy_original_members(in_zip, out_zip, original_members)
+                    
+                    await processing_message.edit(content=f"処理中です... {len(charts_to_process)}譜面 x {len(final_rates)}レート = 計{len(charts_to_process) * len(final_rates)}差分を生成します。")
                     
-                    audio_bytes = audio_files[chart["audio_name"]]
-                    audio_format = chart["audio_name"].rsplit('.', 1)[-1].lower()
+                    total_charts_processed = 0
+                    stream_batch = [] # ストリーミング送信待ちの差分 [(ファイル名, バイト列), ...]
+                    stream_queue = None
+                    stream_sender = None
+                    if stream_batch_size:
+                        # 送信は別タスクで行い、アップロード中も次の差分の処理を続ける
+                        stream_queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+                        stream_sender = asyncio.create_task(self._stream_sender(ctx, stream_queue, original_zip_name, processing_message))
                     
-                    base_chart_data = self._desofflan(chart["data"]) if desofflan else chart["data"]
-
-                    for rate in final_rates:
-                        # 1.0倍かつソフラン除去なしの差分はスキップ (元ファイルが既にあるため)
-                        if abs(rate - 1.0) < 1e-9 and not desofflan:
-                            continue 
-                        
-                        try:
-                            # 音声を処理 (no_pitchフラグを渡す)
-                            new_audio_bytes = self._process_audio(audio_bytes, audio_format, rate, no_pitch)
-                            
-                            new_audio_name = chart["audio_name"].rsplit('.', 1)[0] + f"_rate{rate:.3f}x.mp3"
-                            
-                            new_mc_data = self._process_mc_file(base_chart_data, rate, new_audio_name, desofflan, chart["original_bpm"])
-                            new_mc_name = chart["name"].rsplit('.', 1)[0] + f"_{'desofflan_' if desofflan else ''}rate{rate:.3f}x.mc"
-                            
+                    try:
+                        # --- 5. レートごとに譜面と音声を処理 ---
+                        # 割り当てられたメモリに収まる数のレートを同時に処理する
+                        variants = self._iter_variants(in_zip, charts_to_process, audio_members, final_rates, desofflan, options["no_pitch"], reservation["parallel"])
+                        while True:
+                            # 重い処理なのでイベントループを止めないよう、1差分ずつ別スレッドで実行する
+                            event = await loop.run_in_executor(None, profiling.wrap(next), variants, None)
+                            if event is None:
+                                break
+                            kind, payload = event
+                            if kind == "warning":
+                                await ctx.send(payload)
+                                continue
+
                             # 新しい差分ファイルを追加 (元ファイルはすでにあるので上書きではない)
-                            out_zip.writestr(new_audio_name, new_audio_bytes)
-                            out_zip.writestr(new_mc_name, json.dumps(new_mc_data, indent=2).encode('utf-8'))
-                            
+                            out_zip.writestr(payload["audio_name"], payload["audio_bytes"])
+                            out_zip.writestr(payload["mc_name"], payload["mc_bytes"])
                             total_charts_processed += 1
-                        
-                        except Exception as process_e:
-                            await ctx.send(f"警告: レート `{rate:.3f}x` の譜面 `{chart['name']}` の処理中にエラーが発生しました。スキップします。\n`{process_e}`")
-                            print(traceback.format_exc())
+
+                            # ストリーミング送信: 完成した差分をまとめて送信タスクに渡す
+                            if stream_batch_size:
+                                stream_batch.append((payload["mc_name"], payload["mc_bytes"]))
+                                stream_batch.append((payload["audio_name"], payload["audio_bytes"]))
+                                if len(stream_batch) >= stream_batch_size * 2:
+                                    await stream_queue.put(stream_batch)
+                                    stream_batch = []
+
+                        # 端数の差分を送信
+                        if stream_batch:
+                            await stream_queue.put(stream_batch)
+                            stream_batch = []
+                    finally:
+                        # 送信待ちの差分をすべて送ってから、最後のパックの送信に進む
+                        if stream_sender is not None:
+                            if not stream_sender.done():
+                                await stream_queue.put(None)
+                            await stream_sender
 
 
             # --- 6. 結果を送信 ---
@@ -459,7 +1118,7 @@ class MalodyCog(commands.Cog):
                     loop = self.bot.loop
                     download_url = await loop.run_in_executor(
                         None,
-                        self._upload_to_litterbox,
+                        profiling.wrap(self._upload_to_litterbox),
                         file_bytes,
                         new_zip_name
                     )
@@ -492,6 +1151,16 @@ class MalodyCog(commands.Cog):
             await processing_message.edit(content=f"エラー: 譜面の処理中に予期せぬ問題が発生しました。\n`{e}`")
             await ctx.message.remove_reaction("⏳", self.bot.user)
             await ctx.message.add_reaction("❌")
+        finally:
+            # メモリの割り当てを返却し、実測値を記録する
+            if reservation is not None:
+                observed_bytes = memory_sampler.stop() if memory_sampler is not None else None
+                self._record_memory_usage(original_zip_name, raw_base_bytes + reservation["parallel"] * raw_per_rate_bytes, observed_bytes, reservation)
+                await self.memory_budget.release(reservation)
+            # 一時ファイルを削除する
+            if os.path.exists(input_zip_path):
+                try: os.remove(input_zip_path)
+                except OSError as e: print(f"Error deleting file {input_zip_path}: {e}")
 
 
 # このCogをボットに読み込ませるためのセットアップ関数
@@ -9,6 +9,8 @@ import uuid
 import re # 正規表現ライブラリ
 import aiohttp # サムネイルダウンロード用
 
+import profiling # /profile によるオーナー用のプロファイル
+
 # 一時ファイルを保存するディレクトリ名を定義
 TEMP_DIR = "temp_audio"
 # Discordのファイルサイズ上限 (無料枠 25MB)
@@ -30,11 +32,12 @@ class MusicCog(commands.Cog):
     # -----------------------------------------------------------------
     # 内部処理用の共通メソッド
     # -----------------------------------------------------------------
-    async def _download_and_process_media(self, ctx, url: str, is_mp3: bool, get_thumbnail: bool):
+    async def _download_and_process_media(self, ctx, url: str, is_mp3: bool, get_thumbnail: bool, clip=None):
         """
         動画のダウンロード、変換、送信を行う共通メソッド
         :param is_mp3: TrueならMP3、FalseならMP4
         :param get_thumbnail: Trueならサムネイルも送信
+        :param clip: (開始秒, 終了秒) を指定すると、その区間だけをダウンロードする (終了秒はNoneで最後まで)
         """
         processing_message = await ctx.reply("処理中です... URLから情報を取得しています。")
         
@@ -57,10 +60,24 @@ class MusicCog(commands.Cog):
             
             with yt_dlp.YoutubeDL(info_opts) as ydl:
                 info_dict = await loop.run_in_executor(
-                    None, lambda: ydl.extract_info(url, download=False)
+                    None, profiling.wrap(lambda: ydl.extract_info(url, download=False))
                 )
                 video_title = info_dict.get('title', video_title)
                 thumbnail_url = info_dict.get('thumbnail')
+                duration = info_dict.get('duration')
+
+            # 区間指定 (クリップ) の検証
+            if clip:
+                clip_start, clip_end = clip
+                if duration:
+                    if clip_start >= duration:
+                        await processing_message.edit(content=f"エラー: 開始時刻 `{self._format_timestamp(clip_start)}` が動画の長さ `{self._format_timestamp(duration)}` を超えています。")
+                        return
+                    clip_end = min(clip_end, duration) if clip_end is not None else duration
+                elif clip_end is None:
+                    await processing_message.edit(content="エラー: この動画は長さが取得できないため、終了時刻 (`--end`) も指定してください。")
+                    return
+                clip = (clip_start, clip_end)
                 
             # ファイル名として使えない文字をサニタイズ
             safe_title = re.sub(r'[\\/:*?"<>|]', '_', video_title)
@@ -69,6 +86,9 @@ class MusicCog(commands.Cog):
                 safe_title = "downloaded_media"
             if len(safe_title) > 80:
                 safe_title = safe_title[:80]
+            if clip:
+                # ファイル名に区間を付ける (例: タイトル_1-02-10_1-02-40)
+                safe_title += "_" + "_".join(self._format_timestamp(t).replace(":", "-") for t in clip)
 
             # 2. ダウンロードと変換のオプションを設定
             ydl_opts = {
@@ -79,6 +99,13 @@ class MusicCog(commands.Cog):
                 'no_warnings': True,
             }
 
+            if clip:
+                # 指定区間だけをダウンロードする (ffmpegの入力シークで必要な範囲だけを取得・変換する)
+                ydl_opts['download_ranges'] = yt_dlp.utils.download_range_func(None, [clip])
+                if not is_mp3:
+                    # 動画はキーフレーム以外で切るとずれるため、切れ目を再エンコードする
+                    ydl_opts['force_keyframes_at_cuts'] = True
+
             if is_mp3:
                 # MP3変換のポストプロセッサを追加
                 ydl_opts['postprocessors'] = [{
@@ -91,12 +118,16 @@ class MusicCog(commands.Cog):
                 # MP4の場合はファイルがそのまま出力される (yt-dlpが拡張子を自動で付加)
                 final_extension = ".mp4" # もしくは .webm などになる可能性もある
 
-            await processing_message.edit(content=f"処理中です... 「{video_title}」をダウンロード・変換しています。")
+            if clip:
+                clip_label = f"{self._format_timestamp(clip[0])}～{self._format_timestamp(clip[1])}"
+                await processing_message.edit(content=f"処理中です... 「{video_title}」の {clip_label} をダウンロード・変換しています。")
+            else:
+                await processing_message.edit(content=f"処理中です... 「{video_title}」をダウンロード・変換しています。")
 
             # 3. ダウンロード実行
             with yt_dlp.YoutubeDL(ydl_opts) as ydl:
                 download_info = await loop.run_in_executor(
-                    None, lambda: ydl.extract_info(url, download=True)
+                    None, profiling.wrap(lambda: ydl.extract_info(url, download=True))
                 )
             
             # 最終的なファイルパスを特定
@@ -116,7 +147,10 @@ class MusicCog(commands.Cog):
                 raise FileNotFoundError("変換・ダウンロード後のファイルが見つかりませんでした。")
             
             if os.path.getsize(final_filepath) > DISCORD_FILE_LIMIT:
-                await processing_message.edit(content=f"エラー: ファイル「{video_title}」はサイズが25MBを超えているため、送信できません。")
+                if clip:
+                    await processing_message.edit(content=f"エラー: 「{video_title}」の {clip_label} はサイズが25MBを超えているため、送信できません。区間を短くしてください。")
+                else:
+                    await processing_message.edit(content=f"エラー: ファイル「{video_title}」はサイズが25MBを超えているため、送信できません。\n`--clip 開始-終了` で必要な区間だけを指定できます。")
                 return
 
             await processing_message.edit(content="処理完了！ファイルを作成しています...")
@@ -184,45 +218,104 @@ class MusicCog(commands.Cog):
     # Discordコマンド
     # -----------------------------------------------------------------
 
+    def _parse_timestamp(self, text):
+        """
+        時刻の文字列を秒数に変換する
+        例: "1:02:10" -> 3730.0, "2:30" -> 150.0, "45.5" -> 45.5
+        """
+        parts = text.strip().split(":")
+        if not 1 <= len(parts) <= 3:
+            raise commands.BadArgument(f"時刻 `{text}` の形式が正しくありません。(例: 1:02:10, 2:30, 45)")
+        try:
+            seconds = 0.0
+            for part in parts:
+                value = float(part)
+                if value < 0:
+                    raise ValueError
+                seconds = seconds * 60 + value
+        except ValueError:
+            raise commands.BadArgument(f"時刻 `{text}` の形式が正しくありません。(例: 1:02:10, 2:30, 45)")
+        return seconds
+
+    def _format_timestamp(self, seconds):
+        """秒数を "h:mm:ss" (1時間未満は "m:ss") 形式の文字列に変換する"""
+        seconds = int(seconds)
+        hours, rest = divmod(seconds, 3600)
+        minutes, secs = divmod(rest, 60)
+        if hours:
+            return f"{hours}:{minutes:02d}:{secs:02d}"
+        return f"{minutes}:{secs:02d}"
+
     def _parse_args(self, args):
         """コマンドの引数をパースしてURLとオプションを分離する"""
         url = None
         get_thumbnail = False
+        clip_start = None
+        clip_end = None
         
-        for arg in args:
+        i = 0
+        while i < len(args):
+            arg = args[i]
             if arg.lower() in ('--thumb', '-t', '--thumbnail'):
                 get_thumbnail = True
+            elif arg.lower() in ('--start', '--end', '--clip'):
+                if i + 1 >= len(args):
+                    raise commands.BadArgument(f"`{arg}` の後に時刻を指定してください。")
+                value = args[i + 1]
+                if arg.lower() == '--start':
+                    clip_start = self._parse_timestamp(value)
+                elif arg.lower() == '--end':
+                    clip_end = self._parse_timestamp(value)
+                else:
+                    if value.count("-") != 1:
+                        raise commands.BadArgument("`--clip` は `開始-終了` の形式で指定してください。(例: --clip 1:02:10-1:02:40)")
+                    start_text, end_text = value.split("-")
+                    clip_start = self._parse_timestamp(start_text)
+                    clip_end = self._parse_timestamp(end_text)
+                i += 1
             elif 'http://' in arg or 'https://' in arg:
                 url = arg
+            i += 1
         
         if not url:
             raise commands.BadArgument("URLが見つかりません。")
+
+        clip = None
+        if clip_start is not None or clip_end is not None:
+            clip_start = clip_start or 0.0
+            if clip_end is not None and clip_end <= clip_start:
+                raise commands.BadArgument("終了時刻は開始時刻より後にしてください。")
+            clip = (clip_start, clip_end)
             
-        return url, get_thumbnail
+        return url, get_thumbnail, clip
 
     @commands.command(name="mp3")
     async def mp3_command(self, ctx, *args):
         """
         指定されたURLの音声をMP3に変換します。
-        使い方: !mp3 <URL> [--thumb または -t]
+        使い方: !mp3 <URL> [--thumb または -t] [--clip 開始-終了 または --start 開始 --end 終了]
+        例: !mp3 <URL> --clip 1:02:10-1:02:40
         """
         try:
-            url, get_thumbnail = self._parse_args(args)
-            await self._download_and_process_media(ctx, url, is_mp3=True, get_thumbnail=get_thumbnail)
+            url, get_thumbnail, clip = self._parse_args(args)
+            async with profiling.profile_command(self.bot, ctx, "mp3"):
+                await self._download_and_process_media(ctx, url, is_mp3=True, get_thumbnail=get_thumbnail, clip=clip)
         except commands.BadArgument as e:
-            await ctx.reply(f"エラー: {e}\n使い方: `!mp3 <URL> [--thumb]`")
+            await ctx.reply(f"エラー: {e}\n使い方: `!mp3 <URL> [--thumb] [--clip 1:02:10-1:02:40]`")
 
     @commands.command(name="mp4")
     async def mp4_command(self, ctx, *args):
         """
         指定されたURLの動画をMP4としてダウンロードします。
-        使い方: !mp4 <URL> [--thumb または -t]
+        使い方: !mp4 <URL> [--thumb または -t] [--clip 開始-終了 または --start 開始 --end 終了]
+        例: !mp4 <URL> --clip 1:02:10-1:02:40
         """
         try:
-            url, get_thumbnail = self._parse_args(args)
-            await self._download_and_process_media(ctx, url, is_mp3=False, get_thumbnail=get_thumbnail)
+            url, get_thumbnail, clip = self._parse_args(args)
+            async with profiling.profile_command(self.bot, ctx, "mp4"):
+                await self._download_and_process_media(ctx, url, is_mp3=False, get_thumbnail=get_thumbnail, clip=clip)
         except commands.BadArgument as e:
-            await ctx.reply(f"エラー: {e}\n使い方: `!mp4 <URL> [--thumb]`")
+            await ctx.reply(f"エラー: {e}\n使い方: `!mp4 <URL> [--thumb] [--clip 1:02:10-1:02:40]`")
 
 
 # このCogをボットに読み込ませるためのセットアップ関数
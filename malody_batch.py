@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+"""
+Discordを使わずに、フォルダ内の.mcz/.zip譜面パックのレート差分をまとめて生成するバッチ処理
+!malody と同じ処理 (MalodyCog) を使い、複数のプロセスで並列に処理する
+
+使い方: python malody_batch.py <入力フォルダ> <出力フォルダ> [レート/オプション] [--workers N]
+例: python malody_batch.py charts/ packs/ --range 1.05 1.5 0.05 --no-pitch --workers 4
+レート/オプションは !malody と同じ (--range, --bpm, --desofflan, --desofflan-only, --no-pitch)
+"""
+
+import argparse
+import os
+import sys
+import time
+import traceback
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from cogs.malody_cog import MalodyCog
+
+# ワーカープロセスごとに1つ作成するMalodyCog (ボットなしで譜面処理のメソッドだけを使う)
+_cog = None
+
+
+def _init_worker():
+    """ワーカープロセスの初期化"""
+    global _cog
+    _cog = MalodyCog(None)
+
+
+def build_rate_pack(input_path, output_dir, options):
+    """
+    1つの譜面パックのレート差分を生成して出力フォルダに書き出す (ワーカープロセスで実行)
+    :return: 処理結果の辞書
+    """
+    start_time = time.perf_counter()
+    file_name = os.path.basename(input_path)
+    result = {
+        "name": file_name,
+        "output": None,
+        "variants": 0,
+        "audio_seconds": 0.0,
+        "warnings": [],
+        "error": None,
+    }
+    output_path = os.path.join(output_dir, file_name.rsplit('.', 1)[0] + "_rate_pack.mcz")
+    # 途中で失敗した場合に壊れたパックが残らないよう、完成してから名前を変更する
+    temp_output_path = output_path + ".part"
+
+    try:
+        with _cog._open_pack(input_path) as in_zip:
+            charts_to_process, audio_members, original_members, warnings = _cog._scan_pack(in_zip)
+            result["warnings"].extend(warnings)
+            if not charts_to_process:
+                raise ValueError("`.mcz` ファイル内に `.mc` 譜面ファイルが見つかりません。")
+
+            final_rates, warnings = _cog._compute_final_rates(charts_to_process, options)
+            result["warnings"].extend(warnings)
+
+            with zipfile.ZipFile(temp_output_path, 'w', zipfile.ZIP_DEFLATED) as out_zip:
+                _cog._copy_original_members(in_zip, out_zip, original_members)
+
+                variants = _cog._iter_variants(in_zip, charts_to_process, audio_members, final_rates, options["desofflan"], options["no_pitch"])
+                for kind, payload in variants:
+                    if kind == "warning":
+                        result["warnings"].append(payload)
+                        continue
+                    out_zip.writestr(payload["audio_name"], payload["audio_bytes"])
+                    out_zip.writestr(payload["mc_name"], payload["mc_bytes"])
+                    result["variants"] += 1
+                    result["audio_seconds"] += payload["audio_seconds"]
+
+        if result["variants"] == 0:
+            raise ValueError("処理できる有効な差分がありませんでした。")
+
+        os.replace(temp_output_path, output_path)
+        result["output"] = output_path
+
+    except Exception as e:
+        print(traceback.format_exc())
+        result["error"] = f"{e}"
+    finally:
+        if os.path.exists(temp_output_path):
+            try: os.remove(temp_output_path)
+            except OSError as e: print(f"Error deleting file {temp_output_path}: {e}")
+
+    result["elapsed"] = time.perf_counter() - start_time
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="フォルダ内の.mcz/.zip譜面パックのレート差分をまとめて生成します。",
+        epilog="レート/オプションは !malody と同じです。例: 1.1 1.2 --desofflan / --range 1.05 1.2 0.05 / --bpm 180 200 / --no-pitch",
+        allow_abbrev=False,
+    )
+    parser.add_argument("input_dir", help="譜面パック (.mcz/.zip) が入ったフォルダ")
+    parser.add_argument("output_dir", help="生成したパックを書き出すフォルダ")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count() or 1, help="並列に処理するプロセス数 (既定: CPUコア数)")
+    args, malody_args = parser.parse_known_args()
+
+    try:
+        options = MalodyCog(None)._parse_malody_args(malody_args)
+    except Exception as e:
+        parser.error(f"レート/オプションが正しくありません: {e}")
+    if options["stream_batch_size"]:
+        print("注意: --stream / --stream-batch はバッチ処理では無視されます。")
+
+    input_paths = sorted(
+        os.path.join(args.input_dir, name)
+        for name in os.listdir(args.input_dir)
+        if name.lower().endswith((".mcz", ".zip"))
+    )
+    if not input_paths:
+        parser.error(f"`{args.input_dir}` に .mcz / .zip ファイルが見つかりません。")
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    workers = max(1, min(args.workers, len(input_paths)))
+    print(f"{len(input_paths)} 個のパックを {workers} プロセスで処理します...")
+
+    results = []
+    start_time = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        futures = [executor.submit(build_rate_pack, path, args.output_dir, options) for path in input_paths]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            for warning in result["warnings"]:
+                print(f"  [{result['name']}] {warning}")
+            if result["error"]:
+                print(f"[失敗] {result['name']}: {result['error']} ({result['elapsed']:.1f} 秒)")
+            else:
+                print(f"[完了] {result['name']}: {result['variants']} 差分 -> {result['output']} ({result['elapsed']:.1f} 秒)")
+    elapsed = time.perf_counter() - start_time
+
+    # --- 処理速度のまとめ ---
+    succeeded = [r for r in results if not r["error"]]
+    total_variants = sum(r["variants"] for r in succeeded)
+    total_audio_seconds = sum(r["audio_seconds"] for r in succeeded)
+    print("------")
+    print(f"パック: {len(succeeded)} 成功 / {len(results) - len(succeeded)} 失敗")
+    print(f"差分: {total_variants} 個 (音声 合計 {total_audio_seconds / 60:.1f} 分)")
+    print(f"経過時間: {elapsed:.1f} 秒 ({workers} プロセス)")
+    if elapsed > 0:
+        print(f"処理速度: {len(succeeded) / elapsed * 60:.2f} パック/分, {total_variants / elapsed:.2f} 差分/秒, 音声 {total_audio_seconds / elapsed:.1f} 倍速")
+
+    sys.exit(1 if len(succeeded) < len(results) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+
+"""
+オーナー用のオンデマンドプロファイラー
+
+/profile で有効にすると、次のN回の !malody / !mp3 / !mp4 の実行中に
+イベントループとワーカースレッドのCPUプロファイル (cProfile) と
+tracemalloc のメモリ確保の上位を記録し、結果をオーナーにDMで送る
+有効でないときは、コマンドごとにカウンターとContextVarを1回確認するだけ
+"""
+
+import contextlib
+import contextvars
+import cProfile
+import functools
+import io
+import marshal
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+import traceback
+
+import discord
+
+# 一度に有効にできる回数の上限
+MAX_PROFILE_COUNT = 20
+# tracemalloc で記録するスタックの深さ
+TRACEMALLOC_FRAMES = 10
+# レポートに載せる関数・メモリ確保箇所の数
+REPORT_TOP_FUNCTIONS = 25
+REPORT_TOP_ALLOCATIONS = 15
+# DMの本文に載せる関数の数 (Discordのメッセージは2000文字まで)
+SUMMARY_TOP_FUNCTIONS = 8
+# Python 3.11まではcProfileをスレッドごとに有効にできる
+# 3.12以降は sys.monitoring を使うため、インタープリター全体で1つしか有効にできない
+# (その代わり、1つのプロファイラーに全スレッドの呼び出しが記録される)
+PER_THREAD_PROFILER = sys.version_info < (3, 12)
+
+# 残りのプロファイル回数と、結果を送るオーナーのユーザーID
+_remaining = 0
+_owner_id = None
+# 実行中のセッション (cProfileは1スレッドに1つしか有効にできないため、同時に1つだけ)
+_active_session = None
+# 現在のコマンド (asyncioのタスク、またはワーカースレッド) のセッション
+_current_session = contextvars.ContextVar("profile_session", default=None)
+
+
+def arm(count, owner_id):
+    """次のcount回のコマンド実行をプロファイルするよう設定する"""
+    global _remaining, _owner_id
+    _remaining = max(0, min(count, MAX_PROFILE_COUNT))
+    _owner_id = owner_id
+    return _remaining
+
+
+def disarm():
+    """プロファイルの予約を取り消す (実行中のセッションはそのまま最後まで記録する)"""
+    global _remaining
+    _remaining = 0
+
+
+def remaining():
+    """残りのプロファイル回数"""
+    return _remaining
+
+
+def wrap(func):
+    """
+    run_in_executor などで別スレッドに渡す関数を、現在のセッションのプロファイル対象にする
+    プロファイル中でなければ func をそのまま返す
+    """
+    session = _current_session.get()
+    if session is None:
+        return func
+    return session.wrap(func)
+
+
+@contextlib.asynccontextmanager
+async def profile_command(bot, ctx, command_name):
+    """
+    プロファイルが有効なら、このブロック内の処理を記録してオーナーにDMでレポートを送る
+    """
+    global _remaining, _active_session
+    if _remaining <= 0 or _active_session is not None:
+        yield
+        return
+
+    _remaining -= 1
+    session = ProfileSession(command_name, ctx.message.content, _owner_id)
+    _active_session = session
+    token = _current_session.set(session)
+    # プロファイルの失敗でコマンド自体が失敗しないようにする
+    try:
+        session.start()
+    except Exception as e:
+        print(f"プロファイルの開始に失敗しました: {e}")
+    try:
+        yield
+    finally:
+        try:
+            session.stop()
+        except Exception as e:
+            print(f"プロファイルの終了に失敗しました: {e}")
+        _current_session.reset(token)
+        _active_session = None
+        await session.send_report(bot)
+
+
+class ProfileSession:
+    """1回のコマンド実行のプロファイル結果"""
+    def __init__(self, command_name, command_text, owner_id):
+        self.command_name = command_name
+        self.command_text = command_text
+        self.owner_id = owner_id
+        self.loop_profile = cProfile.Profile()
+        self.loop_profile_enabled = False
+        self.worker_profiles = []
+        self.worker_calls = 0
+        self.errors = [] # プロファイラーを有効にできなかった理由
+        self._lock = threading.Lock()
+        self._started_tracemalloc = False
+        self._start_time = time.perf_counter()
+        self.elapsed = 0.0
+        self.snapshot = None
+        self.traced_peak = 0
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self._started_tracemalloc = True
+        tracemalloc.reset_peak()
+        self._start_time = time.perf_counter()
+        try:
+            self.loop_profile.enable()
+            self.loop_profile_enabled = True
+        except ValueError as e:
+            # 他のプロファイラーが有効な場合 (3.12以降はどのスレッドのものでも) は記録しない
+            self.errors.append(f"イベントループ: {e}")
+
+    def stop(self):
+        if self.loop_profile_enabled:
+            self.loop_profile.disable()
+        self.elapsed = time.perf_counter() - self._start_time
+        if not tracemalloc.is_tracing():
+            return
+        self.traced_peak = tracemalloc.get_traced_memory()[1]
+        self.snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+
+    def wrap(self, func):
+        """
+        別スレッドで実行される関数を、そのスレッド用のcProfileで記録する
+        (3.12以降はイベントループのプロファイラーが全スレッドを記録するので、回数だけ数える)
+        """
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # このスレッドの中でさらに別スレッドに渡す関数も記録できるようにする
+            token = _current_session.set(self)
+            with self._lock:
+                self.worker_calls += 1
+            profile = None
+            if PER_THREAD_PROFILER:
+                profile = cProfile.Profile()
+                try:
+                    profile.enable()
+                except ValueError as e:
+                    profile = None
+                    with self._lock:
+                        self.errors.append(f"ワーカースレッド: {e}")
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if profile is not None:
+                    profile.disable()
+                    with self._lock:
+                        self.worker_profiles.append(profile)
+                _current_session.reset(token)
+        return wrapper
+
+    def _format_stats(self, profiles, limit):
+        """cProfileの結果を累積時間順のテキストにする"""
+        buffer = io.StringIO()
+        stats = pstats.Stats(*profiles, stream=buffer)
+        stats.sort_stats("cumulative").print_stats(limit)
+        return buffer.getvalue(), stats
+
+    def build_report(self):
+        """
+        レポートを作成する
+        :return: (DMの本文, 添付ファイルのリスト [(ファイル名, バイト列), ...])
+        """
+        loop_label = "イベントループ" if PER_THREAD_PROFILER else "全スレッド"
+        lines = [
+            f"コマンド: {self.command_text}",
+            f"実行時間: {self.elapsed:.2f} 秒",
+            f"tracemallocのピーク: {self.traced_peak / (1024*1024):.1f} MB",
+            f"ワーカースレッドの呼び出し: {self.worker_calls} 回",
+            *(f"警告: プロファイラーを有効にできませんでした ({error})" for error in self.errors),
+            f"※{loop_label}のプロファイルには、同時に実行された他のコマンドの処理も含まれます。",
+            "",
+        ]
+
+        files = []
+        sections = []
+        loop_stats = None
+        if self.loop_profile_enabled:
+            loop_text, loop_stats = self._format_stats([self.loop_profile], REPORT_TOP_FUNCTIONS)
+            files.append((f"{self.command_name}_loop.prof", marshal.dumps(loop_stats.stats)))
+            sections += [f"=== {loop_label} (cProfile, 累積時間順) ===", loop_text]
+        worker_stats = None
+        if self.worker_profiles:
+            worker_text, worker_stats = self._format_stats(self.worker_profiles, REPORT_TOP_FUNCTIONS)
+            files.append((f"{self.command_name}_worker.prof", marshal.dumps(worker_stats.stats)))
+            sections += ["=== ワーカースレッド (cProfile, 累積時間順) ===", worker_text]
+
+        if self.snapshot is not None:
+            sections.append("=== メモリ確保の上位 (tracemalloc, 終了時点で確保されているもの) ===")
+            for stat in self.snapshot.statistics("lineno")[:REPORT_TOP_ALLOCATIONS]:
+                frame = stat.traceback[0]
+                sections.append(f"{stat.size / 1024:10.1f} KiB {stat.count:8d} 回  {frame.filename}:{frame.lineno}")
+
+        report = "\n".join(lines) + "\n".join(sections)
+        files.append((f"{self.command_name}_report.txt", report.encode("utf-8")))
+
+        # DMの本文には、一番時間がかかったスレッドの上位の関数だけを載せる
+        summary = "\n".join(lines[:-2])
+        summary_stats = worker_stats or loop_stats
+        if summary_stats is not None:
+            top_functions = []
+            for (filename, lineno, name), (_, _, total_time, cumulative_time, _) in sorted(
+                summary_stats.stats.items(), key=lambda item: item[1][3], reverse=True
+            )[:SUMMARY_TOP_FUNCTIONS]:
+                top_functions.append(f"{cumulative_time:8.2f}s {total_time:8.2f}s  {name} ({filename.rsplit('/', 1)[-1]}:{lineno})")
+            summary += "\n```\n  累積      自身    関数\n" + "\n".join(top_functions) + "\n```"
+        return summary[:2000], files
+
+    async def send_report(self, bot):
+        """レポートをオーナーにDMで送る"""
+        try:
+            summary, files = self.build_report()
+            owner = bot.get_user(self.owner_id) or await bot.fetch_user(self.owner_id)
+            await owner.send(
+                content=f"**プロファイル結果: `!{self.command_name}`** (残り {remaining()} 回)\n{summary}"[:2000],
+                files=[discord.File(io.BytesIO(file_bytes), filename=file_name) for file_name, file_bytes in files],
+            )
+        except Exception as e:
+            print(f"プロファイル結果の送信に失敗しました: {e}")
+            print(traceback.format_exc())
@@ -9,6 +9,8 @@ import os
 import asyncio
 from dotenv import load_dotenv
 
+import profiling # /profile によるオーナー用のプロファイル
+
 # .envファイルから環境変数を読み込む
 load_dotenv()
 TOKEN = os.getenv('DISCORD_BOT_TOKEN')
@@ -87,6 +89,24 @@ async def reload(interaction: discord.Interaction, cog_name: str):
     except Exception as e:
         await interaction.response.send_message(f"リロード中にエラーが発生しました: `{e}`", ephemeral=True)
 
+# 次のN回の重いコマンドをプロファイルし、結果をオーナーにDMで送る (本番環境での調査用)
+@bot.tree.command(name="profile", description="次のN回の !malody / !mp3 / !mp4 をプロファイルし、結果をDMで送ります。")
+@commands.is_owner() # ボットのオーナーのみ実行可能
+async def profile(interaction: discord.Interaction, count: int = 1):
+    """次のN回のコマンド実行のプロファイルを予約するスラッシュコマンド (0で取り消し)"""
+    # commands.is_owner() はスラッシュコマンドには適用されないため、ここでも確認する
+    if not await bot.is_owner(interaction.user):
+        await interaction.response.send_message("このコマンドはボットのオーナーのみ実行できます。", ephemeral=True)
+        return
+    if count <= 0:
+        profiling.disarm()
+        await interaction.response.send_message("プロファイルの予約を取り消しました。", ephemeral=True)
+        return
+    count = profiling.arm(count, interaction.user.id)
+    await interaction.response.send_message(
+        f"次の {count} 回の `!malody` / `!mp3` / `!mp4` をプロファイルします。結果はDMで送信します。", ephemeral=True
+    )
+
 
 async def main():
     """COGをロードしてボットを実行するメイン関数"""